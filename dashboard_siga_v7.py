@@ -1,7 +1,9 @@
 import streamlit as st
 import pandas as pd
 import datetime
+import hashlib
 import io
+import pathlib
 import plotly.express as px
 import xlsxwriter
 
@@ -14,6 +16,19 @@ st.sidebar.header("Configurações e Filtros")
 
 arquivo = st.sidebar.file_uploader("📎 Envie a planilha do SIGA (.xlsx)", type=["xlsx"])
 
+# Nomes de meses compartilhados pelo filtro temporal e pelo callback de limpeza;
+# construídos uma única vez no import, fora do caminho quente de rerun
+MONTH_NAMES = {
+    1: "Janeiro", 2: "Fevereiro", 3: "Março", 4: "Abril",
+    5: "Maio", 6: "Junho", 7: "Julho", 8: "Agosto",
+    9: "Setembro", 10: "Outubro", 11: "Novembro", 12: "Dezembro"
+}
+MONTH_NAME_TO_NUM = {v: k for k, v in MONTH_NAMES.items()}
+
+# Cache em disco do DataFrame pré-processado, por hash do arquivo enviado:
+# sobrevive a novas sessões e a expulsões do st.cache_data
+PARQUET_CACHE_DIR = pathlib.Path.home() / ".cache" / "siga"
+
 # --- Função de carregamento e pré-processamento de dados (com caching) ---
 @st.cache_data # <--- Caching para otimizar o carregamento
 def load_and_preprocess_data(uploaded_file):
@@ -21,14 +36,36 @@ def load_and_preprocess_data(uploaded_file):
     Carrega e pré-processa os dados da planilha SIGA.
     Esta função é cacheada para melhorar a performance.
     """
-    df = pd.read_excel(uploaded_file)
+    file_sha = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    cache_path = PARQUET_CACHE_DIR / f"{file_sha}.parquet"
+    if cache_path.exists():
+        try:
+            # Parquet preserva os dtypes já tratados (categorias, Int16/Int8, datas),
+            # então reaproveitar o cache dispensa o parse do XLSX e toda a re-coerção
+            return pd.read_parquet(cache_path)
+        except Exception:
+            # Cache ilegível (ex.: escrita interrompida no passado): descarta o
+            # arquivo e segue pelo caminho normal de parse do XLSX
+            try:
+                cache_path.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+    colunas_excluir = ["Prioritária?", "Status", "Percentual", "Empresa Executora", "Link da OS", "Localização Google Maps"]
+
+    # Engine calamine (Rust) lê o XLSX bem mais rápido que o openpyxl padrão;
+    # usecols pula as colunas descartadas já no parse, em vez de materializá-las
+    # só para removê-las logo em seguida
+    df = pd.read_excel(uploaded_file, engine="calamine", usecols=lambda c: c not in colunas_excluir)
 
     # Converter para datetime do Pandas (datetime64[ns])
     df["Data de Abertura"] = pd.to_datetime(df["Data de Abertura"], errors="coerce")
     df["Última Fiscalização"] = pd.to_datetime(df["Última Fiscalização"], errors="coerce")
 
-    colunas_excluir = ["Prioritária?", "Status", "Percentual", "Empresa Executora", "Link da OS", "Localização Google Maps"]
-    df = df.drop(columns=[col for col in colunas_excluir if col in df.columns])
+    # Decompõe ano/mês da fiscalização uma única vez no carregamento; os filtros
+    # reutilizam estas colunas em vez de refazer .dt.year/.dt.month a cada rerun
+    df["_uf_year"] = df["Última Fiscalização"].dt.year.astype("Int16")
+    df["_uf_month"] = df["Última Fiscalização"].dt.month.astype("Int8")
 
     fiscais = {
         "norconsultdr045@gmail.com": "Fiscal Drenagem RPA 4.5",
@@ -42,65 +79,167 @@ def load_and_preprocess_data(uploaded_file):
         "norconsultdr023@gmail.com": "Fiscal Drenagem RPA 2.3",
         "norconsultdr006@gmail.com": "Fiscal Drenagem RPA 6",
     }
-    df["Fiscal"] = df["Fiscal"].replace(fiscais)
-    
+    # Renomear só o pequeno array de categorias em vez de percorrer todas as
+    # linhas com .replace(); o dtype categórico também acelera isin/value_counts
+    df["Fiscal"] = df["Fiscal"].astype("category")
+    df["Fiscal"] = df["Fiscal"].cat.rename_categories(
+        {k: v for k, v in fiscais.items() if k in df["Fiscal"].cat.categories}
+    )
+    # Reordena alfabeticamente pelos nomes novos: as categorias alimentam as
+    # listas de opções da barra lateral direto, sem sorted() por rerun
+    df["Fiscal"] = df["Fiscal"].cat.reorder_categories(sorted(df["Fiscal"].cat.categories))
+
+    for col in ["Tipo de Serviço", "RPA"]:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+
+    # Texto livre em buffers Arrow contíguos em vez de um objeto Python por
+    # célula (isin/unique/máscaras rodam em kernels vetorizados do Arrow);
+    # Fiscal/Tipo/RPA ficam de fora porque já são categóricos
+    for col in ["Bairro", "Logradouro", "Trecho", "Id"]:
+        if col in df.columns and df[col].dtype == object:
+            df[col] = df[col].astype("string[pyarrow]")
+
+    # Chave de ordenação numérica das RPAs: a regex roda uma vez por upload,
+    # em vez de a cada rerun na montagem do gráfico
+    df["_RPA_Num"] = pd.to_numeric(
+        df["RPA"].astype(str).str.extract(r'(\d+)', expand=False), errors="coerce"
+    )
+
+    tmp_path = cache_path.with_suffix(".tmp")
+    try:
+        PARQUET_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Escreve num temporário e renomeia de forma atômica: disco cheio ou
+        # processo morto no meio da escrita nunca deixam um .parquet truncado
+        df.to_parquet(tmp_path, compression="zstd")
+        tmp_path.replace(cache_path)
+    except OSError:
+        # Cache em disco é melhor esforço; sem ele o app funciona normalmente
+        try:
+            tmp_path.unlink(missing_ok=True)
+        except OSError:
+            pass
+
     return df
 
+# --- Função de filtragem cacheada ---
+# O df_original só muda quando um novo arquivo é carregado, então o hash do
+# arquivo (file_sha) serve de chave e o prefixo "_" tira o DataFrame do cálculo,
+# sem re-hashear o conteúdo inteiro a cada interação
+@st.cache_data # <--- Evita refazer a cadeia de filtros a cada interação
+def apply_filters(file_sha, _df_original, tipos_selecionados, fiscais_selecionados, rpas_selecionadas, selected_year, selected_months_nums, hoje):
+    """
+    Aplica todos os filtros selecionados e calcula a coluna de dias sem fiscalização.
+    Cacheada para que arrastar um slider não refaça trabalho com as mesmas entradas.
+    """
+    df_original = _df_original
+    # Uma única máscara combinada e um único fatiamento: cada df[df[...].isin(...)]
+    # intermediário copiaria o DataFrame inteiro mais uma vez
+    mask = (
+        df_original["Tipo de Serviço"].isin(tipos_selecionados)
+        & df_original["Fiscal"].isin(fiscais_selecionados)
+        & df_original["RPA"].isin(rpas_selecionadas)
+    )
+    if selected_year is not None and selected_months_nums is not None:
+        # Colunas _uf_* pré-calculadas no carregamento; NA (sem fiscalização) fica fora
+        mask &= df_original["_uf_year"].eq(selected_year).fillna(False) & df_original["_uf_month"].isin(selected_months_nums)
+
+    # O fatiamento .loc[mask] já materializa um frame novo; assign acrescenta a
+    # coluna de dias sem uma segunda cópia integral do resultado
+    df = df_original.loc[mask]
+    # Subtração vetorizada sobre a coluna datetime64[ns]; NaT vira NA no Int64
+    # anulável, então a coluna aparece como inteiro (e não float) nas tabelas
+    dias = (pd.Timestamp(hoje) - df["Última Fiscalização"]).dt.days.astype("Int64")
+    return df.assign(**{"Dias desde última fiscalização": dias})
+
 # --- Função auxiliar para formatar e baixar o DataFrame ---
 def download_excel_with_formatting(df_to_export, filename, sheet_name):
-    buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
-        # Se houver colunas de data/hora, formate-as para evitar problemas de exibição no Excel
-        for col in df_to_export.select_dtypes(include=['datetime64[ns]']).columns:
-            df_to_export[col] = df_to_export[col].dt.strftime('%Y-%m-%d') # Formato 'AAAA-MM-DD'
+    # Colunas auxiliares internas (prefixo "_") não entram no arquivo exportado
+    df_to_export = df_to_export.drop(columns=[c for c in df_to_export.columns if c.startswith("_")])
 
-        df_to_export.to_excel(writer, index=False, sheet_name=sheet_name)
-
-        # Obter o objeto workbook e worksheet do xlsxwriter
+    buffer = io.BytesIO()
+    # constant_memory grava em streaming, linha a linha (menos RAM e serialização
+    # mais rápida); strings_to_urls=False pula o scan de URL em cada célula de texto
+    with pd.ExcelWriter(
+        buffer,
+        engine="xlsxwriter",
+        engine_kwargs={"options": {"constant_memory": True, "strings_to_urls": False}},
+    ) as writer:
         workbook = writer.book
-        worksheet = writer.sheets[sheet_name]
+        # Em modo constant_memory, larguras e formatos de coluna precisam ser
+        # definidos ANTES de escrever os dados, então a planilha é criada à mão
+        worksheet = workbook.add_worksheet(sheet_name)
 
-        # Definir formato para centralizar o texto
+        # Definir formatos para centralizar o texto
         center_format = workbook.add_format({'align': 'center', 'valign': 'vcenter'})
-
-        # Aplicar formato e ajustar largura das colunas
+        header_format = workbook.add_format({'bold': True, 'align': 'center', 'valign': 'vcenter'})
+        # Datas são gravadas como datetime e formatadas pelo próprio Excel via
+        # num_format da coluna, sem o passe de strftime linha a linha em Python
+        # (que ainda por cima alterava o DataFrame do chamador)
+        date_format = workbook.add_format({'num_format': 'yyyy-mm-dd', 'align': 'center', 'valign': 'vcenter'})
+
+        # Ajustar largura da coluna automaticamente com base no conteúdo.
+        # Para texto, mede apenas os valores ÚNICOS (muito menos que N linhas);
+        # para colunas numéricas basta uma largura fixa, sem varrer os dados
         for i, col in enumerate(df_to_export.columns):
-            # Aplicar centralização a todas as células da coluna
-            worksheet.set_column(i, i, None, center_format)
-
-            # Ajustar largura da coluna automaticamente com base no conteúdo
-            # Calcula o comprimento máximo do cabeçalho ou do dado mais longo na coluna
-            max_len = max(
-                len(str(col)), # Comprimento do nome da coluna
-                df_to_export[col].astype(str).map(len).max() # Comprimento máximo dos dados na coluna
-            ) + 2 # Adiciona um pequeno padding para melhor visualização
-            worksheet.set_column(i, i, max_len)
+            vals = df_to_export[col]
+            if pd.api.types.is_datetime64_any_dtype(vals):
+                worksheet.set_column(i, i, max(len(str(col)), 10) + 2, date_format)
+                continue
+            if pd.api.types.is_numeric_dtype(vals):
+                max_data_len = 12
+            else:
+                # Limita a amostra de únicos: é só uma estimativa de largura
+                uniques = vals.dropna().unique()[:500]
+                max_data_len = max((len(str(v)) for v in uniques), default=0)
+            max_len = max(len(str(col)), max_data_len) + 2 # Padding para melhor visualização
+            worksheet.set_column(i, i, max_len, center_format)
+
+        # to_excel escreve coluna a coluna, o que não é compatível com streaming;
+        # escrever linha a linha mantém o modo constant_memory válido
+        worksheet.write_row(0, 0, list(df_to_export.columns), header_format)
+        linhas = df_to_export.astype(object).where(df_to_export.notna(), None)
+        for r, row in enumerate(linhas.itertuples(index=False), start=1):
+            worksheet.write_row(r, 0, row)
 
     buffer.seek(0)
     return buffer
 
+# --- Geração cacheada dos buffers de Excel ---
+# A chave combina o hash do arquivo enviado (distingue uploads de mesmas
+# dimensões), o índice do frame (dois conjuntos de filtros diferentes podem ter
+# a mesma forma, mas nunca as mesmas linhas) e a data de hoje (a coluna de dias
+# sem fiscalização muda na virada do dia, como em apply_filters)
+@st.cache_data(hash_funcs={pd.DataFrame: lambda d: (d.shape, tuple(d.columns), tuple(d.index))})
+def build_excel(file_sha, df_to_export, filename, sheet_name, hoje):
+    """Constrói (e cacheia) o buffer de Excel formatado para os botões de download."""
+    return download_excel_with_formatting(df_to_export, filename, sheet_name)
+
+@st.cache_data
+def build_excel_completo(file_sha, _df_original):
+    """
+    Export completo cacheado pelo hash do arquivo enviado: só é reconstruído
+    quando uma planilha diferente é carregada. O prefixo "_" faz o st.cache_data
+    ignorar o DataFrame na chave; retorna bytes para o download_button.
+    """
+    return download_excel_with_formatting(
+        _df_original, "dados_siga_completos_tratados.xlsx", "Dados Completos Tratados"
+    ).getvalue()
+
 # --- Funções de callback para o botão de limpar filtros ---
 def _clear_temporal_filters():
     """Função para resetar os filtros temporais no session_state."""
     if "df_original_available" in st.session_state and not st.session_state["df_original_available"].empty:
-        df_temp = st.session_state["df_original_available"].copy()
-        
-        # Correção: Garante que 'Última Fiscalização' é datetime64[ns] para esta operação
-        df_temp["Última Fiscalização"] = pd.to_datetime(df_temp["Última Fiscalização"], errors="coerce")
-        
-        valid_fiscalizacao_dates = df_temp["Última Fiscalização"].dropna()
+        # A coluna já sai de load_and_preprocess_data como datetime64[ns], então
+        # não é preciso copiar o DataFrame nem re-coagir com pd.to_datetime aqui
+        valid_fiscalizacao_dates = st.session_state["df_original_available"]["Última Fiscalização"].dropna()
 
         if not valid_fiscalizacao_dates.empty:
-            reset_year = valid_fiscalizacao_dates.max().year # Agora deve ser seguro
-            
-            month_names_map = {
-                1: "Janeiro", 2: "Fevereiro", 3: "Março", 4: "Abril", 
-                5: "Maio", 6: "Junho", 7: "Julho", 8: "Agosto", 
-                9: "Setembro", 10: "Outubro", 11: "Novembro", 12: "Dezembro"
-            }
-            # .dt.month agora é seguro para usar
-            reset_months_nums = sorted(list(set(d.month for d in valid_fiscalizacao_dates if pd.notna(d) and d.year == reset_year)))
-            reset_month_names = [month_names_map[m] for m in reset_months_nums]
+            reset_year = valid_fiscalizacao_dates.max().year
+
+            # .dt.year/.dt.month vetorizados sobre a coluna datetime64, sem loop Python
+            reset_months_nums = sorted(valid_fiscalizacao_dates[valid_fiscalizacao_dates.dt.year == reset_year].dt.month.unique())
+            reset_month_names = [MONTH_NAMES[m] for m in reset_months_nums]
             
             st.session_state["fiscal_year_slider"] = reset_year
             st.session_state["fiscal_month_multiselect"] = reset_month_names
@@ -116,17 +255,21 @@ if arquivo:
     # Chama a função de carregamento e pré-processamento cacheada
     df_original = load_and_preprocess_data(arquivo)
 
+    # Hash do arquivo enviado, usado como chave dos caches de filtragem e export
+    file_sha = hashlib.sha256(arquivo.getvalue()).hexdigest()
+
     # Armazenar df_original no session_state para acesso no callback
     st.session_state["df_original_available"] = df_original
 
-    # Cria uma cópia para aplicar os filtros
-    df = df_original.copy()
-
     # --- Filtros ---
     st.sidebar.subheader("Filtros de Dados")
 
+    # A filtragem de fato acontece em apply_filters (cacheada). As listas de
+    # opções saem das categorias do df_original: já únicas e ordenadas, sem
+    # varrer N linhas, e estáveis entre reruns (um filtro não encolhe mais as
+    # opções dos demais)
     # Filtro por tipo de serviço
-    tipos_disponiveis = sorted(df["Tipo de Serviço"].dropna().unique())
+    tipos_disponiveis = list(df_original["Tipo de Serviço"].cat.categories)
     tipo_padrao = ["Buraco SIGA"] if "Buraco SIGA" in tipos_disponiveis else ([] if not tipos_disponiveis else [tipos_disponiveis[0]])
     tipos_selecionados = st.sidebar.multiselect("🛠️ Tipos de Serviço:", tipos_disponiveis, default=tipo_padrao)
 
@@ -134,35 +277,37 @@ if arquivo:
         st.warning("⚠️ Selecione ao menos um tipo de serviço para continuar.")
         st.stop()
 
-    df = df[df["Tipo de Serviço"].isin(tipos_selecionados)]
-
     # Filtro por Fiscal
-    fiscais_disponiveis = sorted(df["Fiscal"].dropna().unique())
+    fiscais_disponiveis = list(df_original["Fiscal"].cat.categories)
     fiscais_selecionados = st.sidebar.multiselect("🧑‍💼 Fiscais:", fiscais_disponiveis, default=fiscais_disponiveis)
-    if fiscais_selecionados:
-        df = df[df["Fiscal"].isin(fiscais_selecionados)]
-    else:
+    if not fiscais_selecionados:
         st.warning("⚠️ Selecione ao menos um fiscal para continuar.")
         st.stop()
 
     # Filtro por RPA
-    rpas_disponiveis = sorted(df["RPA"].dropna().unique())
+    rpas_disponiveis = list(df_original["RPA"].cat.categories)
     rpas_selecionadas = st.sidebar.multiselect("📍 RPAs:", rpas_disponiveis, default=rpas_disponiveis)
-    if rpas_selecionadas:
-        df = df[df["RPA"].isin(rpas_selecionadas)]
-    else:
+    if not rpas_selecionadas:
         st.warning("⚠️ Selecione ao menos uma RPA para continuar.")
         st.stop()
 
+    # Máscara leve usada apenas para montar as opções do filtro temporal
+    mask_opcoes = (
+        df_original["Tipo de Serviço"].isin(tipos_selecionados)
+        & df_original["Fiscal"].isin(fiscais_selecionados)
+        & df_original["RPA"].isin(rpas_selecionadas)
+    )
+
     # --- Análise Temporal da Fiscalização (Unificada) ---
     st.sidebar.markdown("---")
     st.sidebar.subheader("🗓️ Análise Temporal da Fiscalização")
 
     # Obter apenas datas válidas para o filtro de ano/mês
-    valid_fiscalizacao_dates_for_filter = df["Última Fiscalização"].dropna()
+    valid_fiscalizacao_dates_for_filter = df_original.loc[mask_opcoes, "Última Fiscalização"].dropna()
 
     selected_year = None
-    
+    selected_months_nums = None
+
     # Definir estado inicial do slider e multiselect de meses para o st.session_state
     if "fiscal_year_slider" not in st.session_state:
         if not df_original["Última Fiscalização"].dropna().empty:
@@ -196,14 +341,11 @@ if arquivo:
                 key="fiscal_year_slider"
             )
         
-        month_names = {
-            1: "Janeiro", 2: "Fevereiro", 3: "Março", 4: "Abril", 
-            5: "Maio", 6: "Junho", 7: "Julho", 8: "Agosto", 
-            9: "Setembro", 10: "Outubro", 11: "Novembro", 12: "Dezembro"
-        }
-        
-        months_in_selected_year = sorted(list(set(d.month for d in valid_fiscalizacao_dates_for_filter if d.year == selected_year)))
-        available_month_names = [month_names[m] for m in months_in_selected_year]
+        # Colunas _uf_* pré-calculadas em vez de refazer .dt.year/.dt.month aqui
+        months_in_selected_year = sorted(
+            df_original.loc[mask_opcoes & df_original["_uf_year"].eq(selected_year).fillna(False), "_uf_month"].unique()
+        )
+        available_month_names = [MONTH_NAMES[m] for m in months_in_selected_year]
 
         default_months_for_multiselect = [
             m for m in st.session_state["fiscal_month_multiselect"] if m in available_month_names
@@ -218,21 +360,24 @@ if arquivo:
                 default=default_months_for_multiselect,
                 key="fiscal_month_multiselect"
             )
-            selected_months_nums = [list(month_names.keys())[list(month_names.values()).index(m)] for m in selected_months_names]
-
-            df = df[
-                (df["Última Fiscalização"].dt.year == selected_year) &
-                (df["Última Fiscalização"].dt.month.isin(selected_months_nums))
-            ]
+            selected_months_nums = tuple(MONTH_NAME_TO_NUM[m] for m in selected_months_names)
         else:
             st.sidebar.info(f"Nenhum mês disponível para o ano de {selected_year}.")
     else:
         st.sidebar.info("Nenhuma data de última fiscalização válida para filtrar.")
 
-    # Calcula dias desde a última fiscalização para o df principal (para KPIs e gráficos)
+    # Aplica todos os filtros de uma vez (cacheado); a coluna "Dias desde última
+    # fiscalização" para KPIs e gráficos já vem calculada de apply_filters
     hoje = datetime.date.today()
-    df["Dias desde última fiscalização"] = df["Última Fiscalização"].apply(
-        lambda x: (hoje - x.date()).days if pd.notna(x) else None
+    df = apply_filters(
+        file_sha,
+        df_original,
+        tuple(tipos_selecionados),
+        tuple(fiscais_selecionados),
+        tuple(rpas_selecionadas),
+        selected_year,
+        selected_months_nums,
+        hoje,
     )
 
     # Botão para limpar filtros de data, usando o callback
@@ -255,8 +400,11 @@ if arquivo:
     datas_validas_fiscalizacao = df["Última Fiscalização"].dropna()
     
     rpa_contagem = df["RPA"].value_counts()
-    rpa_max = rpa_contagem.idxmax() if not rpa_contagem.empty else "-"
-    rpa_min = rpa_contagem.idxmin() if not rpa_contagem.empty else "-"
+    # Em coluna categórica, categorias fora do filtro apareceriam com contagem zero
+    rpa_contagem = rpa_contagem[rpa_contagem > 0]
+    # value_counts já vem ordenado por contagem: extremos em O(1), sem novo scan
+    rpa_max = rpa_contagem.index[0] if len(rpa_contagem) else "-"
+    rpa_min = rpa_contagem.index[-1] if len(rpa_contagem) else "-"
     
     media_fiscalizacao = df["Dias desde última fiscalização"].mean()
     media_fiscalizacao_str = f"{int(media_fiscalizacao)} dias" if not pd.isna(media_fiscalizacao) else "N/A"
@@ -272,7 +420,9 @@ if arquivo:
     
     # --- Gráficos ---
     st.subheader("🧑‍💼 Atuação dos Fiscais")
-    grafico_fiscal = df["Fiscal"].value_counts().reset_index()
+    fiscal_contagem = df["Fiscal"].value_counts()
+    # Idem: descarta categorias de fiscais sem ocorrência nos dados filtrados
+    grafico_fiscal = fiscal_contagem[fiscal_contagem > 0].reset_index()
     grafico_fiscal.columns = ["Fiscal", "Quantidade"]
     
     if not grafico_fiscal.empty:
@@ -293,13 +443,14 @@ if arquivo:
     df_rpa = rpa_contagem.reset_index()
     df_rpa.columns = ["RPA", "Quantidade"]
     
-    # Usar raw string r'(\d+)' para regex para evitar SyntaxWarning
-    df_rpa["RPA_Num"] = df_rpa["RPA"].astype(str).str.extract(r'(\d+)').astype(int, errors='ignore')
-    if pd.api.types.is_numeric_dtype(df_rpa["RPA_Num"]):
-        df_rpa = df_rpa.sort_values(by="RPA_Num").drop(columns="RPA_Num")
-    else:
-        df_rpa = df_rpa.sort_values(by="RPA")
-        df_rpa = df_rpa.drop(columns="RPA_Num")
+    # Ordena pela chave _RPA_Num pré-calculada no carregamento; RPAs sem número
+    # na descrição ficam no fim (chave NaN)
+    rpa_num_por_rpa = df_original.drop_duplicates("RPA").set_index("RPA")["_RPA_Num"]
+    df_rpa = (
+        df_rpa.assign(_k=df_rpa["RPA"].map(rpa_num_por_rpa))
+        .sort_values("_k", kind="mergesort")
+        .drop(columns="_k")
+    )
 
     if not df_rpa.empty:
         fig_rpa = px.bar(
@@ -317,14 +468,15 @@ if arquivo:
 
     # Gráfico de Tendência Temporal da Última Fiscalização
     st.subheader("📅 Tendência de Última Fiscalização")
-    # Crie uma cópia para evitar SettingWithCopyWarning e garanta o tipo datetime64[ns]
-    df_fiscalizacao_mensal = df.dropna(subset=["Última Fiscalização"]).copy()
-    
-    if not df_fiscalizacao_mensal.empty:
-        # AGORA É SEGURO: .dt.to_period("M") porque a coluna é datetime64[ns]
-        df_fiscalizacao_mensal["Ano-Mês"] = df_fiscalizacao_mensal["Última Fiscalização"].dt.to_period("M").astype(str)
-        fiscalizacao_mensal_contagem = df_fiscalizacao_mensal["Ano-Mês"].value_counts().sort_index().reset_index()
+    fiscalizacao_validas = df["Última Fiscalização"].dropna()
+
+    if not fiscalizacao_validas.empty:
+        # Agrupa direto sobre o Period e converte para string só os períodos
+        # únicos no final, em vez de materializar N strings antes de contar
+        periodos = fiscalizacao_validas.dt.to_period("M")
+        fiscalizacao_mensal_contagem = periodos.value_counts().sort_index().reset_index()
         fiscalizacao_mensal_contagem.columns = ["Ano-Mês", "Número de Fiscalizações"]
+        fiscalizacao_mensal_contagem["Ano-Mês"] = fiscalizacao_mensal_contagem["Ano-Mês"].astype(str)
 
         if not fiscalizacao_mensal_contagem.empty:
             fig_tendencia = px.line(
@@ -344,9 +496,8 @@ if arquivo:
 
 
     # --- Tabela de Alerta (com limite configurável) ---
-    df_alerta_visual = df[df["Dias desde última fiscalização"].apply(
-        lambda x: x > alerta_dias_config if x is not None else False
-    )]
+    # Comparação vetorizada; serviços sem fiscalização (NA) ficam fora do alerta
+    df_alerta_visual = df[df["Dias desde última fiscalização"].gt(alerta_dias_config).fillna(False)]
 
     st.subheader(f"🔴 Serviços com mais de {alerta_dias_config} dias sem fiscalização (Alerta)") 
     if not df_alerta_visual.empty:
@@ -364,29 +515,39 @@ if arquivo:
     st.sidebar.markdown("---")
     st.sidebar.subheader("💾 Exportar Dados")
 
-    # Opção 1: Baixar Dados Completos (Tratados) - PRESENTE AQUI!
-    buffer_completo = download_excel_with_formatting(
-        df_original, "dados_siga_completos_tratados.xlsx", "Dados Completos Tratados"
-    )
-    st.sidebar.download_button(
-        label="📥 Baixar Dados Completos (Tratados)",
-        data=buffer_completo,
-        file_name="dados_siga_completos_tratados.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        help="Baixa todos os dados da planilha original após o pré-processamento, sem considerar os filtros."
-    )
+    # Os buffers de Excel só passam a ser gerados depois que o usuário pede;
+    # sem isso, cada movimento de slider serializava duas planilhas inteiras.
+    # Como build_excel é cacheado, manter o botão visível nos reruns seguintes
+    # só refaz o buffer quando os dados de fato mudam.
+
+    # Opção 1: Baixar Dados Completos (Tratados)
+    if st.sidebar.button("📥 Preparar Dados Completos (Tratados)"):
+        st.session_state["exportar_completo"] = True
+    if st.session_state.get("exportar_completo"):
+        # Chaveado pelo hash do arquivo: filtros não invalidam este buffer
+        buffer_completo = build_excel_completo(file_sha, df_original)
+        st.sidebar.download_button(
+            label="📥 Baixar Dados Completos (Tratados)",
+            data=buffer_completo,
+            file_name="dados_siga_completos_tratados.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            help="Baixa todos os dados da planilha original após o pré-processamento, sem considerar os filtros."
+        )
 
-    # Opção 2: Baixar Dados Filtrados (Atuais) - PRESENTE AQUI!
-    buffer_filtrado = download_excel_with_formatting(
-        df, "dados_siga_filtrados.xlsx", "Dados Filtrados"
-    )
-    st.sidebar.download_button(
-        label="📄 Baixar Dados Filtrados (Atuais)",
-        data=buffer_filtrado,
-        file_name="dados_siga_filtrados.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        help="Baixa os dados visíveis no dashboard, considerando todos os filtros aplicados."
-    )
+    # Opção 2: Baixar Dados Filtrados (Atuais)
+    if st.sidebar.button("📄 Preparar Dados Filtrados (Atuais)"):
+        st.session_state["exportar_filtrado"] = True
+    if st.session_state.get("exportar_filtrado"):
+        buffer_filtrado = build_excel(
+            file_sha, df, "dados_siga_filtrados.xlsx", "Dados Filtrados", hoje
+        )
+        st.sidebar.download_button(
+            label="📄 Baixar Dados Filtrados (Atuais)",
+            data=buffer_filtrado,
+            file_name="dados_siga_filtrados.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            help="Baixa os dados visíveis no dashboard, considerando todos os filtros aplicados."
+        )
 
 else:
     st.info("⬆️ Por favor, envie um arquivo Excel para começar a analisar os dados do SIGA.")